@@ -1,162 +1,343 @@
 import csv
 import datetime as dt
+import io
 import json
+import operator
 import os
+import re
 import sys
-import tempfile
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
 
 try:
     import yaml
 except ImportError as exc:
     raise SystemExit("PyYAML is required. Install with `pip install pyyaml`.") from exc
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 try:
     import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 except ImportError as exc:
     raise SystemExit("requests is required. Install with `pip install requests`.") from exc
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 ENV_PATH = Path(".env")
 CONFIG_PATH = Path("config.yaml")
 
+CONFIG_CACHE_SUFFIX = ".cache.json"
+
+REQUEST_TIMEOUT = 30
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+WRITE_BUFFER_SIZE = 1 << 20
+DATASET_WORKERS = 8
+
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MAX_CONCURRENCY = 8
+
+LINK_RE = re.compile(r'<([^>]+)>[^,<]*?;\s*rel="?([^";,]+)"?')
+ENV_LINE_RE = re.compile(r"^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t\r]*$", re.MULTILINE)
+
 
 def load_env(path: Path) -> None:
     if not path.exists():
         return
-    for line in path.read_text(encoding="utf-8").splitlines():
-        raw = line.strip()
-        if not raw or raw.startswith("#"):
-            continue
-        if "=" not in raw:
-            continue
-        key, value = raw.split("=", 1)
-        os.environ.setdefault(key.strip(), value.strip().strip("\""))
+    pairs: Dict[str, str] = {}
+    for key, value in ENV_LINE_RE.findall(path.read_text(encoding="utf-8")):
+        pairs.setdefault(key, value.strip("\""))
+    os.environ.update({key: value for key, value in pairs.items() if key not in os.environ})
 
 
 def load_config(path: Path) -> Dict[str, Any]:
     if not path.exists():
         raise SystemExit(f"Config not found: {path}")
-    return yaml.safe_load(path.read_text(encoding="utf-8"))
+    stat = path.stat()
+    cache_path = path.with_name(path.name + CONFIG_CACHE_SUFFIX)
+    config = read_config_cache(cache_path, stat)
+    if config is None:
+        config = yaml.load(path.read_text(encoding="utf-8"), Loader=YamlLoader)
+        write_config_cache(cache_path, stat, config)
+    return config
+
+
+def read_config_cache(cache_path: Path, stat: os.stat_result) -> Optional[Dict[str, Any]]:
+    try:
+        cached = json.loads(cache_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict):
+        return None
+    if cached.get("_mtime") != stat.st_mtime_ns or cached.get("_size") != stat.st_size:
+        return None
+    return cached.get("data")
+
+
+def write_config_cache(cache_path: Path, stat: os.stat_result, config: Any) -> None:
+    # Only cache configs that survive a JSON round trip unchanged (no dates, non-str keys, ...).
+    try:
+        data = json.dumps(config, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return
+    if json.loads(data) != config:
+        return
+    payload = f'{{"_mtime": {stat.st_mtime_ns}, "_size": {stat.st_size}, "data": {data}}}'
+    temp_path = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        temp_path.write_text(payload, encoding="utf-8")
+        os.replace(temp_path, cache_path)
+    except OSError:
+        return
 
 
-def resolve_date_range(config: Dict[str, Any], range_name: str) -> Tuple[dt.date, dt.date]:
-    manual = config.get("date_ranges", {}).get("manual", {}).get(range_name, {})
+def resolve_date_range(
+    config: Dict[str, Any],
+    range_name: str,
+    today: Optional[dt.date] = None,
+) -> Tuple[dt.date, dt.date]:
+    date_ranges = config.get("date_ranges", {})
+    manual = date_ranges.get("manual", {}).get(range_name, {})
     if manual.get("start") and manual.get("end"):
         start = dt.date.fromisoformat(manual["start"])
         end = dt.date.fromisoformat(manual["end"])
         return start, end
 
-    offsets = config.get("date_ranges", {}).get(range_name, {})
+    offsets = date_ranges.get(range_name, {})
     start_offset = int(offsets.get("start_offset_days", 0))
     end_offset = int(offsets.get("end_offset_days", 0))
-    today = dt.date.today()
+    if today is None:
+        today = dt.date.today()
     return today + dt.timedelta(days=start_offset), today + dt.timedelta(days=end_offset)
 
 
 def parse_link_header(link_header: Optional[str]) -> Dict[str, str]:
     if not link_header:
         return {}
-    links: Dict[str, str] = {}
-    for part in link_header.split(","):
-        if ";" not in part:
-            continue
-        url_part, rel_part = part.split(";", 1)
-        url = url_part.strip().strip("<>")
-        rel = rel_part.strip()
-        if rel.startswith("rel="):
-            rel_value = rel.split("=", 1)[1].strip("\"")
-            links[rel_value] = url
-    return links
+    return {rel: url for url, rel in LINK_RE.findall(link_header)}
+
 
+def all_plain_dicts(items: List[Any]) -> bool:
+    for item in items:
+        if type(item) is not dict:
+            return False
+    return True
 
-def extract_records(payload: Any) -> List[Dict[str, Any]]:
+
+def extract_records(payload: Any, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
     if isinstance(payload, list):
-        return [item for item in payload if isinstance(item, dict)]
-    if isinstance(payload, dict):
+        items = payload
+    elif isinstance(payload, dict):
+        items = [payload]
         for key in ("data", "items", "results"):
             if isinstance(payload.get(key), list):
-                return [item for item in payload[key] if isinstance(item, dict)]
-        return [payload]
-    return []
+                items = payload[key]
+                break
+    else:
+        return []
+    if fields is None:
+        # Pages are almost always plain lists of dicts; hand those back without copying.
+        if all_plain_dicts(items):
+            return items
+        return [item for item in items if isinstance(item, dict)]
+    return [{field: item.get(field) for field in fields} for item in items if isinstance(item, dict)]
+
+
+def decode_json(content: bytes) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson is stricter (NaN, ints wider than 64 bits); let json have a go.
+            pass
+    return json.loads(content)
 
 
 def fetch_paginated(
+    session: requests.Session,
     url: str,
-    headers: Dict[str, str],
     params: Dict[str, Any],
-    auth: Optional[Tuple[str, str]],
+    fields: Optional[List[str]] = None,
 ) -> List[Dict[str, Any]]:
     records: List[Dict[str, Any]] = []
-    next_url = url
-    next_params = params
-    while next_url:
-        response = requests.get(next_url, headers=headers, params=next_params, auth=auth, timeout=30)
-        response.raise_for_status()
-        records.extend(extract_records(response.json()))
-        links = parse_link_header(response.headers.get("Link"))
-        next_url = links.get("next")
-        next_params = None
+    response = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+    # One prefetch slot per paginator, so concurrent exports never queue behind each other.
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        while response is not None:
+            response.raise_for_status()
+            links = parse_link_header(response.headers.get("Link"))
+            next_url = links.get("next")
+            # Request the next page before decoding this one so the two overlap.
+            future = None
+            if next_url:
+                future = prefetcher.submit(session.get, next_url, params=None, timeout=REQUEST_TIMEOUT)
+            records.extend(extract_records(decode_json(response.content), fields))
+            response = future.result() if future is not None else None
     return records
 
 
-def filter_fields(records: Iterable[Dict[str, Any]], fields: List[str]) -> List[Dict[str, Any]]:
-    filtered = []
-    for record in records:
-        filtered.append({field: record.get(field) for field in fields})
-    return filtered
+def fetch_sources(
+    session: requests.Session,
+    requests_by_source: Dict[str, Tuple[str, Dict[str, Any], Optional[List[str]]]],
+) -> Dict[str, List[Dict[str, Any]]]:
+    if not requests_by_source:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(requests_by_source)) as executor:
+        futures = {
+            source_name: executor.submit(fetch_paginated, session, url, params, fields)
+            for source_name, (url, params, fields) in requests_by_source.items()
+        }
+        return {source_name: future.result() for source_name, future in futures.items()}
+
+
+def filter_fields(records: Iterable[Dict[str, Any]], fields: List[str]) -> Iterator[Dict[str, Any]]:
+    return ({field: record.get(field) for field in fields} for record in records)
+
+
+def build_lookup(records: Iterable[Dict[str, Any]], merge_key: str) -> Dict[Any, Any]:
+    # Keys with a single match (the usual 1:1 join) map straight to the record;
+    # only duplicated keys are promoted to a list.
+    lookup: Dict[Any, Any] = {}
+    for item in records:
+        key = item.get(merge_key)
+        if key is None:
+            continue
+        existing = lookup.get(key)
+        if existing is None:
+            lookup[key] = item
+        elif type(existing) is list:
+            existing.append(item)
+        else:
+            lookup[key] = [existing, item]
+    return lookup
 
 
 def merge_records(
     primary: List[Dict[str, Any]],
-    secondary: List[Dict[str, Any]],
+    secondaries: List[List[Dict[str, Any]]],
     merge_key: str,
 ) -> List[Dict[str, Any]]:
-    if not secondary:
+    # Single pass over primary; rows match merging the secondaries one after another
+    # (duplicate matches fan out in order, unmatched secondaries are skipped).
+    lookups = [build_lookup(records, merge_key) for records in secondaries if records]
+    if not lookups:
         return primary
-    lookup: Dict[Any, List[Dict[str, Any]]] = {}
-    for item in secondary:
-        key = item.get(merge_key)
-        if key is None:
-            continue
-        lookup.setdefault(key, []).append(item)
 
     merged: List[Dict[str, Any]] = []
     for base in primary:
         key = base.get(merge_key)
-        extras = lookup.get(key)
-        if not extras:
-            merged.append(base)
-            continue
-        for extra in extras:
-            combined = {**base, **extra}
-            merged.append(combined)
+        rows = [base]
+        copied = False
+        for lookup in lookups:
+            extras = lookup.get(key)
+            if extras is None:
+                continue
+            if type(extras) is not list:
+                if copied:
+                    for row in rows:
+                        row.update(extras)
+                    continue
+                extras = [extras]
+            expanded = []
+            for row in rows:
+                for extra in extras:
+                    combined = row.copy()
+                    combined.update(extra)
+                    expanded.append(combined)
+            rows = expanded
+            copied = True
+        merged.extend(rows)
     return merged
 
 
-def write_csv(path: Path, records: List[Dict[str, Any]], fields: List[str]) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8", newline="") as file:
-        writer = csv.DictWriter(file, fieldnames=fields)
-        writer.writeheader()
-        for record in records:
-            writer.writerow({field: record.get(field) for field in fields})
+def iter_rows(records: List[Dict[str, Any]], fields: List[str]) -> Iterable[Iterable[Any]]:
+    # itemgetter only works when every record has every field; merged rows lack a
+    # secondary source's fields when it had no match, so check once up front.
+    required = frozenset(fields)
+    if len(fields) > 1 and all(record.keys() >= required for record in records):
+        return map(operator.itemgetter(*fields), records)
+    return ([record.get(field) for field in fields] for record in records)
+
+
+def write_csv(file: BinaryIO, records: List[Dict[str, Any]], fields: List[str]) -> None:
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(fields)
+    writer.writerows(iter_rows(records, fields))
+    text.flush()
+    text.detach()
+
+
+def dump_json_record(record: Dict[str, Any]) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(record, option=orjson.OPT_INDENT_2)
+        except TypeError:
+            pass
+    return json.dumps(record, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def write_json(file: BinaryIO, records: Iterable[Dict[str, Any]]) -> None:
+    # Laid out like json.dumps(list(records), indent=2), one record at a time. With orjson,
+    # float spelling can differ (1e-7 vs 1e-07) and NaN/Infinity are written as null.
+    separator = b"[\n  "
+    for record in records:
+        file.write(separator)
+        file.write(dump_json_record(record).replace(b"\n", b"\n  "))
+        separator = b",\n  "
+    file.write(b"[]" if separator == b"[\n  " else b"\n]")
 
 
-def write_json(path: Path, records: List[Dict[str, Any]]) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(json.dumps(records, ensure_ascii=False, indent=2), encoding="utf-8")
+def write_records(
+    file: BinaryIO,
+    records: List[Dict[str, Any]],
+    output_format: str,
+    output_fields: List[str],
+) -> None:
+    if output_format == "json":
+        write_json(file, filter_fields(records, output_fields) if output_fields else records)
+    else:
+        write_csv(file, records, output_fields or sorted(records[0].keys()) if records else [])
 
 
-def upload_to_s3(path: Path, bucket: str, key: str, region: Optional[str]) -> None:
+def build_s3_client(region: Optional[str]) -> Any:
     try:
         import boto3
     except ImportError as exc:
         raise SystemExit("boto3 is required for S3 upload. Install with `pip install boto3`.") from exc
 
+    from botocore.config import Config
+
+    # Every export thread can run S3_MAX_CONCURRENCY part uploads at once over this client.
+    client_config = Config(max_pool_connections=DATASET_WORKERS * S3_MAX_CONCURRENCY)
     session = boto3.session.Session(region_name=region)
-    client = session.client("s3")
-    client.upload_file(str(path), bucket, key)
+    return session.client("s3", config=client_config)
+
+
+def build_transfer_config() -> Any:
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        max_concurrency=S3_MAX_CONCURRENCY,
+        use_threads=True,
+    )
+
+
+def upload_to_s3(client: Any, transfer_config: Any, path: Path, bucket: str, key: str) -> None:
+    client.upload_file(str(path), bucket, key, Config=transfer_config)
+
+
+def upload_fileobj_to_s3(client: Any, transfer_config: Any, file: BinaryIO, bucket: str, key: str) -> None:
+    client.upload_fileobj(file, bucket, key, Config=transfer_config)
 
 
 def build_headers(token: str, token_header: str) -> Dict[str, str]:
@@ -175,6 +356,85 @@ def build_basic_auth(username: str, password: str) -> Optional[Tuple[str, str]]:
     return None
 
 
+def build_session(
+    headers: Dict[str, str],
+    auth: Optional[Tuple[str, str]],
+    pool_size: int,
+) -> requests.Session:
+    session = requests.Session()
+    session.headers.update(headers)
+    session.auth = auth
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def export_dataset(
+    session: requests.Session,
+    base_url: str,
+    dataset_name: str,
+    dataset_config: Dict[str, Any],
+    range_name: str,
+    date_range: Tuple[dt.date, dt.date],
+    output_format: str,
+    output_dir: Optional[Path],
+    s3_client: Any,
+    s3_transfer_config: Any,
+    s3_config: Dict[str, Any],
+) -> None:
+    sources = dataset_config.get("sources", {})
+    primary_source_name = dataset_config.get("primary_source") or next(iter(sources.keys()))
+    output_fields = dataset_config.get("output_fields", [])
+    start_date, end_date = date_range
+
+    requests_by_source: Dict[str, Tuple[str, Dict[str, Any], Optional[List[str]]]] = {}
+    for source_name, source in sources.items():
+        path = source.get("path", "")
+        date_params = source.get("date_params", {})
+        params = dict(source.get("params", {}))
+        if date_params.get("start"):
+            params[date_params["start"]] = start_date.isoformat()
+        if date_params.get("end"):
+            params[date_params["end"]] = end_date.isoformat()
+        if source.get("per_page"):
+            params["per_page"] = source["per_page"]
+        requests_by_source[source_name] = (f"{base_url}{path}", params, source.get("fields") or None)
+
+    fetched = fetch_sources(session, requests_by_source)
+
+    primary_records = fetched.get(primary_source_name, [])
+    merge_key = dataset_config.get("merge_key", "reservation_id")
+
+    secondaries = [records for source_name, records in fetched.items() if source_name != primary_source_name]
+    merged_records = merge_records(primary_records, secondaries, merge_key)
+
+    extension = "json" if output_format == "json" else "csv"
+    filename = f"{dataset_name}_{range_name}.{extension}"
+    prefix = s3_config.get("prefix", "")
+    key = "/".join(part.strip("/") for part in [prefix, filename] if part)
+
+    if output_dir is not None:
+        output_path = output_dir / filename
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with output_path.open("wb", buffering=WRITE_BUFFER_SIZE) as file:
+            write_records(file, merged_records, output_format, output_fields)
+        if s3_client is not None:
+            upload_to_s3(s3_client, s3_transfer_config, output_path, s3_config["bucket"], key)
+    elif s3_client is not None:
+        # S3-only output: serialize in memory and upload without a round trip through disk.
+        buffer = io.BytesIO()
+        write_records(buffer, merged_records, output_format, output_fields)
+        buffer.seek(0)
+        upload_fileobj_to_s3(s3_client, s3_transfer_config, buffer, s3_config["bucket"], key)
+
+
 def main() -> None:
     load_env(ENV_PATH)
     config = load_config(CONFIG_PATH)
@@ -198,76 +458,65 @@ def main() -> None:
     s3_config = config.get("output", {}).get("s3", {})
     s3_enabled = bool(s3_config.get("enabled", False))
 
+    today = dt.date.today()
     ranges = {
-        "history": resolve_date_range(config, "history"),
-        "onhand": resolve_date_range(config, "onhand"),
+        "history": resolve_date_range(config, "history", today),
+        "onhand": resolve_date_range(config, "onhand", today),
     }
 
     datasets = config.get("datasets", {})
     if not datasets:
         raise SystemExit("No datasets configured in config.yaml")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir)
-        for dataset_name, dataset_config in datasets.items():
-            sources = dataset_config.get("sources", {})
-            if not sources:
-                continue
-            primary_source_name = dataset_config.get("primary_source") or next(iter(sources.keys()))
-            output_fields = dataset_config.get("output_fields", [])
-
-            for range_name, (start_date, end_date) in ranges.items():
-                fetched: Dict[str, List[Dict[str, Any]]] = {}
-                for source_name, source in sources.items():
-                    path = source.get("path", "")
-                    date_params = source.get("date_params", {})
-                    params = dict(source.get("params", {}))
-                    if date_params.get("start"):
-                        params[date_params["start"]] = start_date.isoformat()
-                    if date_params.get("end"):
-                        params[date_params["end"]] = end_date.isoformat()
-                    if source.get("per_page"):
-                        params["per_page"] = source["per_page"]
-
-                    url = f"{base_url}{path}"
-                    records = fetch_paginated(url, headers, params, auth)
-                    fields = source.get("fields", [])
-                    if fields:
-                        records = filter_fields(records, fields)
-                    fetched[source_name] = records
-
-                primary_records = fetched.get(primary_source_name, [])
-                merge_key = dataset_config.get("merge_key", "reservation_id")
-
-                merged_records = primary_records
-                for source_name, records in fetched.items():
-                    if source_name == primary_source_name:
-                        continue
-                    merged_records = merge_records(merged_records, records, merge_key)
-
-                if output_fields:
-                    merged_records = filter_fields(merged_records, output_fields)
-
-                extension = "json" if output_format == "json" else "csv"
-                filename = f"{dataset_name}_{range_name}.{extension}"
-                if local_enabled:
-                    output_path = local_dir / filename
-                else:
-                    output_path = temp_path / filename
-
-                if output_format == "json":
-                    write_json(output_path, merged_records)
-                else:
-                    write_csv(output_path, merged_records, output_fields or sorted(merged_records[0].keys()) if merged_records else [])
-
-                if s3_enabled:
-                    bucket = s3_config.get("bucket")
-                    prefix = s3_config.get("prefix", "")
-                    region = s3_config.get("region")
-                    if not bucket:
-                        raise SystemExit("S3 bucket is required when s3.enabled is true")
-                    key = "/".join(part.strip("/") for part in [prefix, filename] if part)
-                    upload_to_s3(output_path, bucket, key, region)
+    s3_client = None
+    s3_transfer_config = None
+    if s3_enabled:
+        if not s3_config.get("bucket"):
+            raise SystemExit("S3 bucket is required when s3.enabled is true")
+        # boto3 clients are thread-safe, so one client serves every export thread.
+        s3_client = build_s3_client(s3_config.get("region"))
+        s3_transfer_config = build_transfer_config()
+
+    tasks = [
+        (dataset_name, dataset_config, range_name, date_range)
+        for dataset_name, dataset_config in datasets.items()
+        if dataset_config.get("sources")
+        for range_name, date_range in ranges.items()
+    ]
+
+    output_dir = local_dir if local_enabled else None
+    # Every (dataset, range) pair writes its own file, so they can run side by side. Each
+    # export fetches all of its sources at once with one request in flight per source.
+    export_workers = min(DATASET_WORKERS, len(tasks))
+    max_sources = max((len(dataset_config["sources"]) for _, dataset_config, _, _ in tasks), default=1)
+    pool_size = max(1, export_workers * max_sources)
+
+    with build_session(headers, auth, pool_size) as session:
+        if tasks:
+            with ThreadPoolExecutor(max_workers=export_workers) as executor:
+                futures = [
+                    executor.submit(
+                        export_dataset,
+                        session,
+                        base_url,
+                        dataset_name,
+                        dataset_config,
+                        range_name,
+                        date_range,
+                        output_format,
+                        output_dir,
+                        s3_client,
+                        s3_transfer_config,
+                        s3_config,
+                    )
+                    for dataset_name, dataset_config, range_name, date_range in tasks
+                ]
+                done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+                # Stop at the first failure instead of letting the queued exports run.
+                for future in not_done:
+                    future.cancel()
+                for future in done:
+                    future.result()
 
     print("Data export completed.")
 